@@ -9,7 +9,11 @@
 #    schroot to create a chroot environment
 # 3. Install a raspbian buster chroot system at /var/chroot/raspbian_buster_armhf
 #    Thanks to qemu-user-static and binfmt-support, this environment
-#    can be emulated transparently and used as a normal chroot
+#    can be emulated transparently and used as a normal chroot.
+#    The bootstrapped chroot is cached at /var/cache/raspbian_buster_armhf.tar
+#    and reused if the chroot needs to be reinstalled. If the
+#    RASPBIAN_ROOTFS_URL environment variable points to a prebuilt
+#    armhf rootfs .tar.xz, it is unpacked instead of running debootstrap
 # 4. Create a gcc "specs" file that overrides the default flags
 #    passed to subtools such as ld. By default, the compiler always
 #    links for armv7. This is due to the standard object files
@@ -20,7 +24,8 @@
 #    accomplish the cross compilation. These flags configure the
 #    compiler to produce armv6 instructions, and set a number
 #    of obscure preprocessor defines to match the raspbian
-#    compiler
+#    compiler. Link time optimization is enabled, configure with
+#    -DRPI_LTO=OFF to disable it
 #
 # The result of these steps is a toolchain file located at
 # /opt/toolchains/gcc-8-armv6.cmake .  Programs can be
@@ -50,95 +55,218 @@ import re
 from pathlib import Path
 import os
 import pwd
+import io
+import shlex
+import string
+import socket
+import concurrent.futures
+import glob
 
-def c(cmd):
-    subprocess.check_call(cmd, shell=True)
-
-def getuser():
-    return pwd.getpwuid(os.geteuid()).pw_name
-
-def install_host_deps():
-    c("sudo apt update")
-    c("sudo apt install -y gcc-8-arm-linux-gnueabihf g++-8-arm-linux-gnueabihf cmake build-essential" \
-      "qemu-user-static binfmt-support debootstrap schroot" )
+lib_suffix_re = re.compile(r"\.(?:a|so(?:\.\d+)?)$")
+specs_section_re = re.compile(r"^(\*\w+:)$", re.MULTILINE)
 
-def make_dirs():
-    c("sudo mkdir -p /opt/toolchains")
-    c("sudo mkdir -p /var/chroot")
+def c(cmd):
+    subprocess.check_call(cmd)
 
-def install_chroot():
+def sudo_write(path, text):
+    # Write through a temporary file next to the destination so the final
+    # rename is atomic and needs only one sudo call
+    subprocess.run(["sudo", "sh", "-c", 'cat > "$1.tmp" && chmod 644 "$1.tmp" && mv "$1.tmp" "$1"', "sh", path],
+                   input=text, check=True, text=True)
 
-    if not Path("/usr/share/keyrings/raspbian-archive-keyring.gpg").is_file():
-        c("cd /tmp && wget http://archive.raspbian.org/raspbian/pool/main/r/raspbian-archive-keyring/raspbian-archive-keyring_20120528.2_all.deb")
-        c("sudo dpkg -i /tmp/raspbian-archive-keyring_20120528.2_all.deb")
+def find_apt_proxy():
+    # Use a local apt-cacher-ng (port 3142) or squid-deb-proxy (port 8000) if one is running
+    for port in (3142, 8000):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+        except OSError:
+            continue
+        print(f"Using apt proxy at http://127.0.0.1:{port}")
+        return f"http://127.0.0.1:{port}"
+    return None
 
-    if not Path("/var/chroot/raspbian_buster_armhf/bin/bash").exists():
-        c("sudo debootstrap --arch armhf --foreign --keyring=/usr/share/keyrings/raspbian-archive-keyring.gpg buster /var/chroot/raspbian_buster_armhf http://ftp.acc.umu.se/mirror/raspbian/raspbian/")
-        c("sudo cp /usr/bin/qemu-arm* /var/chroot/raspbian_buster_armhf/usr/bin")
-        c("sudo chroot /var/chroot/raspbian_buster_armhf /debootstrap/debootstrap --second-stage")
+def apt_proxy_opts(apt_proxy):
+    return ["-o", f"Acquire::http::Proxy={apt_proxy}"] if apt_proxy else []
 
-    username= getuser()
-    schroot_config2 = schroot_config.replace("{user}", username)
-    with open("/tmp/raspbian_buster_armhf", "w") as f:
-        f.write(schroot_config2)
-    c("sudo chown root:root /tmp/raspbian_buster_armhf")
-    c("sudo mv /tmp/raspbian_buster_armhf /etc/schroot/chroot.d/")
+def apt_install_host(pkgs, apt_proxy=None):
+    c(["sudo", "DEBIAN_FRONTEND=noninteractive", "apt"] + apt_proxy_opts(apt_proxy) +
+      ["install", "-y", "--no-install-recommends", "-o", "Dpkg::Options::=--force-confold"] + pkgs)
 
-    c("sudo schroot -c raspbian_buster_armhf -- apt-get update")
-    c("sudo schroot -c raspbian_buster_armhf -- apt-get install -y build-essential g++ gcc cmake")
+def install_debootstrap(apt_proxy=None):
+    c(["sudo", "apt"] + apt_proxy_opts(apt_proxy) + ["update"])
+    apt_install_host(["debootstrap"], apt_proxy)
 
-def write_gcc_specs():
-    proc = subprocess.Popen(["/usr/bin/arm-linux-gnueabihf-g++-8", "-dumpspecs"], stdout=subprocess.PIPE)
+def install_host_deps(apt_proxy=None):
+    pkgs = ["gcc-8-arm-linux-gnueabihf", "g++-8-arm-linux-gnueabihf", "cmake", "build-essential",
+            "qemu-user-static", "binfmt-support", "schroot"]
+    apt_install_host(pkgs, apt_proxy)
 
-    specs = proc.stdout.read().decode("utf-8")
+def make_dirs():
+    c(["sudo", "mkdir", "-p", "/opt/toolchains", "/var/chroot"])
+
+def raspbian_keyring():
+    # Unpack the keyring with dpkg-deb instead of installing it, so this does
+    # not take the dpkg lock while install_host_deps is running
+    if Path("/usr/share/keyrings/raspbian-archive-keyring.gpg").is_file():
+        return "/usr/share/keyrings/raspbian-archive-keyring.gpg"
+    if not Path("/tmp/raspbian-archive-keyring_20120528.2_all.deb").is_file():
+        c(["wget", "-P", "/tmp", "http://archive.raspbian.org/raspbian/pool/main/r/raspbian-archive-keyring/raspbian-archive-keyring_20120528.2_all.deb"])
+    c(["dpkg-deb", "-x", "/tmp/raspbian-archive-keyring_20120528.2_all.deb", "/tmp/raspbian-archive-keyring"])
+    return "/tmp/raspbian-archive-keyring/usr/share/keyrings/raspbian-archive-keyring.gpg"
+
+def download_prebuilt_rootfs(url):
+    # Unpacking a prebuilt armhf rootfs avoids running the debootstrap
+    # second stage under qemu emulation
+    try:
+        c(["wget", "-O", "/tmp/raspbian_buster_armhf_rootfs.tar.xz", url])
+    except subprocess.CalledProcessError:
+        print("Could not download prebuilt rootfs, falling back to debootstrap")
+        return False
+    return True
+
+def populate_chroot(apt_proxy=None):
+    # Fill /var/chroot/raspbian_buster_armhf without running anything inside it,
+    # so this can run alongside install_host_deps. Returns how the chroot was
+    # populated, or None if it already existed
+    if Path("/var/chroot/raspbian_buster_armhf/bin/bash").exists():
+        return None
+
+    if Path("/var/cache/raspbian_buster_armhf.tar").is_file():
+        c(["sudo", "tar", "--numeric-owner", "-C", "/var/chroot", "-xf", "/var/cache/raspbian_buster_armhf.tar"])
+        return "cache"
+
+    if prebuilt_rootfs_url and download_prebuilt_rootfs(prebuilt_rootfs_url):
+        c(["sudo", "mkdir", "-p", "/var/chroot/raspbian_buster_armhf"])
+        c(["sudo", "tar", "--numeric-owner", "-xJf", "/tmp/raspbian_buster_armhf_rootfs.tar.xz",
+           "-C", "/var/chroot/raspbian_buster_armhf"])
+        return "prebuilt"
+
+    # The first stage only downloads and unpacks packages and does not need qemu
+    debootstrap_env = [f"http_proxy={apt_proxy}"] if apt_proxy else []
+    c(["sudo"] + debootstrap_env + ["debootstrap", "--variant=minbase", "--include=eatmydata,raspbian-archive-keyring", "--arch", "armhf",
+       "--foreign", f"--keyring={raspbian_keyring()}", "buster",
+       "/var/chroot/raspbian_buster_armhf", "http://ftp.acc.umu.se/mirror/raspbian/raspbian/"])
+    return "debootstrap"
+
+def binfmt_fix_binary():
+    # With the binfmt_misc F flag the kernel opens the qemu interpreter when
+    # the handler is registered, so it does not need to exist in the chroot
+    try:
+        with open("/proc/sys/fs/binfmt_misc/qemu-arm") as f:
+            binfmt = f.read()
+    except OSError:
+        return False
+    for line in binfmt.splitlines():
+        if line.startswith("flags:"):
+            return "F" in line.split(":", 1)[1]
+    return False
+
+def copy_qemu_to_chroot():
+    if binfmt_fix_binary():
+        return
+    c(["sudo", "cp"] + glob.glob("/usr/bin/qemu-arm*") + ["/var/chroot/raspbian_buster_armhf/usr/bin"])
+
+def install_chroot(apt_proxy=None, populated=None):
+
+    if populated is not None:
+        copy_qemu_to_chroot()
+
+    if populated == "debootstrap":
+        c(["sudo", "chroot", "/var/chroot/raspbian_buster_armhf", "/debootstrap/debootstrap", "--second-stage"])
+        # Cache the bootstrapped chroot so reinstalls skip debootstrap. Write to
+        # a temporary file first so an interrupted tar never leaves a truncated cache.
+        # The host qemu is left out so a restore always gets the current one
+        c(["sudo", "sh", "-c", 'tar --numeric-owner -C /var/chroot --exclude="raspbian_buster_armhf/usr/bin/qemu-arm*" ' \
+           '-cf "$1.tmp" raspbian_buster_armhf && mv "$1.tmp" "$1"', "sh", "/var/cache/raspbian_buster_armhf.tar"])
+
+    sudo_write("/etc/schroot/chroot.d/raspbian_buster_armhf", schroot_config.substitute(user=username))
+
+    schroot = ["sudo", "schroot", "-c", "raspbian_buster_armhf", "--"]
+    apt_opts = apt_proxy_opts(apt_proxy) + ["-o", "Acquire::http::Pipeline-Depth=10"]
+    c(schroot + ["apt-get"] + apt_opts + ["update"])
+    # eatmydata turns dpkg's fsync calls into no-ops, which are expensive under qemu emulation
+    c(schroot + ["apt-get"] + apt_opts + ["install", "-y", "eatmydata"])
+    c(schroot + ["eatmydata", "apt-get"] + apt_opts + ["install", "-y", "--no-install-recommends",
+                                                       "build-essential", "g++", "gcc", "cmake"])
+
+def scan_chroot():
+    # Walk the chroot library directories once, collecting the crt objects
+    # for write_gcc_specs and the library symlinks under lib for
+    # fix_absolute_links
+    obj_index = {}
+    lib_symlinks = []
+    dirs = [(os.path.join(chroot_dir, "lib"), True), (os.path.join(chroot_dir, "usr/lib"), False)]
+    while dirs:
+        d, in_lib = dirs.pop()
+        with os.scandir(d) as it:
+            entries = list(it)
+        for entry in entries:
+            # DirEntry type checks use the dirent type and avoid a stat per file
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append((entry.path, in_lib))
+            elif entry.name in crt_objects:
+                obj_index.setdefault(entry.name, entry.path)
+            elif in_lib and lib_suffix_re.search(entry.name) is not None and entry.is_symlink():
+                lib_symlinks.append(entry.path)
+    return obj_index, lib_symlinks
+
+def write_gcc_specs(obj_index):
+    specs = subprocess.run(["/usr/bin/arm-linux-gnueabihf-g++-8", "-dumpspecs"],
+                           check=True, capture_output=True, text=True).stdout
     specs = specs.replace("%D",ld_search_paths)
 
+    # Only the crt startup/shutdown objects found by scan_chroot need absolute paths
     def replace_with_path(m):
-        
         obj = m.group()
-        try:
-            obj_absolute = str(next(Path("/var/chroot/raspbian_buster_armhf").rglob(obj)))
-        except StopIteration:
-            return obj
-        print("specs replacing: " + m.group() + " found absolute " + obj_absolute)
+        obj_absolute = obj_index[obj]
+        print("specs replacing: " + obj + " found absolute " + obj_absolute)
         return obj_absolute
 
-    specs = re.sub(r"\w+\.o", replace_with_path, specs)
-
-    with open("/tmp/gcc-8-armv6-specs.txt", "w") as f:
-        f.write(specs)
+    if obj_index:
+        # Word boundaries keep e.g. crt1.o from matching inside gcrt1.o
+        obj_re = re.compile(r"\b(?:" + "|".join(re.escape(o) for o in obj_index) + r")(?!\w)")
+        # Only the link related sections reference crt objects
+        parts = specs_section_re.split(specs)
+        for i in range(1, len(parts), 2):
+            if parts[i] in crt_specs_sections:
+                parts[i + 1] = obj_re.sub(replace_with_path, parts[i + 1])
+        specs = "".join(parts)
 
-    c("sudo mv /tmp/gcc-8-armv6-specs.txt /opt/toolchains/")
+    sudo_write("/opt/toolchains/gcc-8-armv6-specs.txt", specs)
 
 def write_cmake_toolchain():
-    with open("/tmp/gcc-8-armv6.cmake","w") as f:
-        f.write(cmake_toolchain_text)
-    c("sudo mv /tmp/gcc-8-armv6.cmake /opt/toolchains/")
+    sudo_write("/opt/toolchains/gcc-8-armv6.cmake", cmake_toolchain_text)
 
-def fix_absolute_links():
-    for path in Path("/var/chroot/raspbian_buster_armhf/lib").rglob("*"):
-        if not path.is_symlink():
+def fix_absolute_links(lib_symlinks):
+    ln_cmds = io.StringIO()
+    for path in lib_symlinks:
+        link_target = os.readlink(path)
+        if not os.path.isabs(link_target):
             continue
+        rel_link_target = os.path.relpath(chroot_dir + link_target, start=os.path.dirname(path))
+        print("replace " + path + " -> " + link_target + " with relative link " + rel_link_target)
 
-        m = re.match(r".*(?:(?:\.so(?:\.\d+)?)|(?:\.a))$", path.name)
-        if m is None:
-            continue
-        link_target = Path(os.readlink(path))
-        if not link_target.is_absolute():
-            continue
-        rel_link_target = "../"*(len(Path(str(path).replace("/var/chroot/raspbian_buster_armhf","")).parent.parts)-1) + str(link_target).lstrip("/")
-        print("replace " + str(path) + " -> " + str(link_target) + " with relative link " + rel_link_target)
+        ln_cmds.write(f"ln -sfn {shlex.quote(rel_link_target)} {shlex.quote(path)}\n")
 
-        print(f"cd {path.parent} && sudo ln -fs {rel_link_target} {path.name}")
-        c(f"cd {path.parent} && sudo ln -fs {rel_link_target} {path.name}")
+    if ln_cmds.tell() > 0:
+        subprocess.run(["sudo", "sh"], input=ln_cmds.getvalue(), check=True, text=True)
 
 def main():
-    install_host_deps()
-    install_chroot()
+    apt_proxy = find_apt_proxy()
     make_dirs()
+    install_debootstrap(apt_proxy)
+    # Overlap the host package install with populating the chroot. Only the
+    # second stage and the chroot apt steps need qemu from the host packages
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        host_deps = executor.submit(install_host_deps, apt_proxy)
+        chroot = executor.submit(populate_chroot, apt_proxy)
+        populated = chroot.result()
+        host_deps.result()
+    install_chroot(apt_proxy, populated)
+    obj_index, lib_symlinks = scan_chroot()
     write_cmake_toolchain()
-    write_gcc_specs()
-    fix_absolute_links()
+    write_gcc_specs(obj_index)
+    fix_absolute_links(lib_symlinks)
 
 cmake_toolchain_text= \
 """
@@ -149,9 +277,23 @@ set(CMAKE_SYSROOT /var/chroot/raspbian_buster_armhf)
 
 set(CMAKE_C_COMPILER /usr/bin/arm-linux-gnueabihf-gcc-8)
 set(CMAKE_CXX_COMPILER /usr/bin/arm-linux-gnueabihf-g++-8)
-set(CMAKE_C_FLAGS " -mcpu=arm1176jzf-s -mtune=arm1176jzf-s  -isystem=/var/chroot/raspbian_buster_armhf  -march=armv6 -mfpu=vfp -mfloat-abi=hard -marm -D__GCC_HAVE_SYNC_COMPARE_AND_SWAP_1 -D__GCC_HAVE_SYNC_COMPARE_AND_SWAP_2 -D__GCC_HAVE_SYNC_COMPARE_AND_SWAP_8 -D__ARM_FEATURE_LDREX=4 -D__GCC_ATOMIC_BOOL_LOCK_FREE=1 -D__GCC_ATOMIC_CHAR_LOCK_FREE=1 -D__GCC_ATOMIC_CHAR16_T_LOCK_FREE=1 -D__GCC_ATOMIC_LLONG_LOCK_FREE=1 -D__GCC_ATOMIC_SHORT_LOCK_FREE=1 -D__pic__ -D__PIC__ -D__pie__ -D__PIE__ -Wl,--sysroot=/var/chroot/raspbian_buster_armhf -specs=/opt/toolchains/gcc-8-armv6-specs.txt  " )
-set(CMAKE_CXX_FLAGS "-mcpu=arm1176jzf-s -mtune=arm1176jzf-s  -isystem=/var/chroot/raspbian_buster_armhf  -march=armv6 -mfpu=vfp -mfloat-abi=hard -marm -D__GCC_HAVE_SYNC_COMPARE_AND_SWAP_1 -D__GCC_HAVE_SYNC_COMPARE_AND_SWAP_2 -D__GCC_HAVE_SYNC_COMPARE_AND_SWAP_8 -D__ARM_FEATURE_LDREX=4 -D__GCC_ATOMIC_BOOL_LOCK_FREE=1 -D__GCC_ATOMIC_CHAR_LOCK_FREE=1 -D__GCC_ATOMIC_CHAR16_T_LOCK_FREE=1 -D__GCC_ATOMIC_LLONG_LOCK_FREE=1 -D__GCC_ATOMIC_SHORT_LOCK_FREE=1 -D__pic__ -D__PIC__ -D__pie__ -D__PIE__  -Wl,--sysroot=/var/chroot/raspbian_buster_armhf -specs=/opt/toolchains/gcc-8-armv6-specs.txt " )
+set(CMAKE_AR /usr/bin/arm-linux-gnueabihf-gcc-ar-8)
+set(CMAKE_RANLIB /usr/bin/arm-linux-gnueabihf-gcc-ranlib-8)
+
+set(CMAKE_C_FLAGS " -pipe -mcpu=arm1176jzf-s -mtune=arm1176jzf-s  -isystem=/var/chroot/raspbian_buster_armhf  -march=armv6 -mfpu=vfp -mfloat-abi=hard -marm -D__GCC_HAVE_SYNC_COMPARE_AND_SWAP_1 -D__GCC_HAVE_SYNC_COMPARE_AND_SWAP_2 -D__GCC_HAVE_SYNC_COMPARE_AND_SWAP_8 -D__ARM_FEATURE_LDREX=4 -D__GCC_ATOMIC_BOOL_LOCK_FREE=1 -D__GCC_ATOMIC_CHAR_LOCK_FREE=1 -D__GCC_ATOMIC_CHAR16_T_LOCK_FREE=1 -D__GCC_ATOMIC_LLONG_LOCK_FREE=1 -D__GCC_ATOMIC_SHORT_LOCK_FREE=1 -D__pic__ -D__PIC__ -D__pie__ -D__PIE__ -Wl,--sysroot=/var/chroot/raspbian_buster_armhf -specs=/opt/toolchains/gcc-8-armv6-specs.txt  " )
+set(CMAKE_CXX_FLAGS "-pipe -mcpu=arm1176jzf-s -mtune=arm1176jzf-s  -isystem=/var/chroot/raspbian_buster_armhf  -march=armv6 -mfpu=vfp -mfloat-abi=hard -marm -D__GCC_HAVE_SYNC_COMPARE_AND_SWAP_1 -D__GCC_HAVE_SYNC_COMPARE_AND_SWAP_2 -D__GCC_HAVE_SYNC_COMPARE_AND_SWAP_8 -D__ARM_FEATURE_LDREX=4 -D__GCC_ATOMIC_BOOL_LOCK_FREE=1 -D__GCC_ATOMIC_CHAR_LOCK_FREE=1 -D__GCC_ATOMIC_CHAR16_T_LOCK_FREE=1 -D__GCC_ATOMIC_LLONG_LOCK_FREE=1 -D__GCC_ATOMIC_SHORT_LOCK_FREE=1 -D__pic__ -D__PIC__ -D__pie__ -D__PIE__  -Wl,--sysroot=/var/chroot/raspbian_buster_armhf -specs=/opt/toolchains/gcc-8-armv6-specs.txt " )
 
+# Link time optimization is enabled by default. Configure with -DRPI_LTO=OFF to disable it
+option(RPI_LTO "Enable link time optimization" ON)
+list(APPEND CMAKE_TRY_COMPILE_PLATFORM_VARIABLES RPI_LTO)
+if(RPI_LTO)
+  string(APPEND CMAKE_C_FLAGS " -flto -ffat-lto-objects")
+  string(APPEND CMAKE_CXX_FLAGS " -flto -ffat-lto-objects")
+endif()
+
+set(CMAKE_EXE_LINKER_FLAGS_INIT "-fuse-ld=gold")
+set(CMAKE_SHARED_LINKER_FLAGS_INIT "-fuse-ld=gold")
+set(CMAKE_MODULE_LINKER_FLAGS_INIT "-fuse-ld=gold")
 
 set(CMAKE_FIND_ROOT_PATH_MODE_PROGRAM NEVER)
 set(CMAKE_FIND_ROOT_PATH_MODE_LIBRARY ONLY)
@@ -161,20 +303,32 @@ set(CMAKE_FIND_ROOT_PATH_MODE_PACKAGE ONLY)
 
 """
 
+chroot_dir = "/var/chroot/raspbian_buster_armhf"
+
+username = pwd.getpwuid(os.geteuid()).pw_name
+
+# Startup and shutdown objects referenced by the gcc specs
+crt_objects = ("crt1.o", "Scrt1.o", "gcrt1.o", "grcrt1.o", "rcrt1.o", "crti.o", "crtn.o",
+               "crtbegin.o", "crtbeginS.o", "crtbeginT.o", "crtend.o", "crtendS.o", "crtfastmath.o")
+crt_specs_sections = ("*startfile:", "*endfile:", "*link:", "*link_command:")
+
+# Optional URL of a prebuilt raspbian buster armhf rootfs .tar.xz used instead of debootstrap
+prebuilt_rootfs_url = os.environ.get("RASPBIAN_ROOTFS_URL")
+
 ld_search_paths = "-L/var/chroot/raspbian_buster_armhf/lib -L/var/chroot/raspbian_buster_armhf/lib/arm-linux-gnueabihf " \
     "-L/var/chroot/raspbian_buster_armhf/usr/lib -L/var/chroot/raspbian_buster_armhf/usr/lib/arm-linux-gnueabihf " \
     "-L/var/chroot/raspbian_buster_armhf/usr/lib/arm-linux-gnueabihf "\
     "-L/var/chroot/raspbian_buster_armhf/usr/lib/gcc/arm-linux-gnueabihf/8"
 
-schroot_config = \
+schroot_config = string.Template(
 """
 [raspbian_buster_armhf]
 description=Raspbian Buster armhf chroot
 type=directory
 directory=/var/chroot/raspbian_buster_armhf
-users={user}
-root-groups=root,{user}
-"""
+users=$user
+root-groups=root,$user
+""")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file